@@ -48,29 +48,37 @@ class ELmonocleDB:
         timeout=10,
         prefix=CHANGE_PREFIX,
         create=True,
+        http_compress=False,
+        es=None,
     ):
-        host, port = elastic_conn.split(':')
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        ip = socket.gethostbyname(host)
-        self.log.info('ES IP is %s' % ip)
-        self.log.info('ES prefix is %s' % prefix)
-
-        while True:
-            try:
-                s.connect((ip, int(port)))
-                s.shutdown(2)
-                s.close()
-                break
-            except Exception as excpt:
-                self.log.info(
-                    'Unable to connect to %s: %s. Sleeping for %ds.'
-                    % (elastic_conn, excpt, timeout)
-                )
-                time.sleep(timeout)
+        if es is not None:
+            # Reuse the client and the connection pool of another instance
+            self.es = es
+        else:
+            host, port = elastic_conn.split(':')
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            ip = socket.gethostbyname(host)
+            self.log.info('ES IP is %s' % ip)
+            self.log.info('ES prefix is %s' % prefix)
+
+            while True:
+                try:
+                    s.connect((ip, int(port)))
+                    s.shutdown(2)
+                    s.close()
+                    break
+                except Exception as excpt:
+                    self.log.info(
+                        'Unable to connect to %s: %s. Sleeping for %ds.'
+                        % (elastic_conn, excpt, timeout)
+                    )
+                    time.sleep(timeout)
 
-        self.log.info('Connecting to ES server at %s' % elastic_conn)
-        self.es = client.Elasticsearch(elastic_conn)
-        self.log.info(self.es.info())
+            self.log.info('Connecting to ES server at %s' % elastic_conn)
+            self.es = client.Elasticsearch(
+                elastic_conn, maxsize=25, http_compress=http_compress
+            )
+            self.log.info(self.es.info())
 
         self.prefix = prefix
 
@@ -224,7 +232,8 @@ class ELmonocleDB:
     def run_named_query(self, name, *args, **kwargs):
         # Here we set gte and lte if not provided by user
         # especially to be able to set the histogram extended_bounds
-        if name not in queries.public_queries:
+        query = queries.QUERY_REGISTRY.get(name)
+        if not query:
             raise UnknownQueryException("Unknown query: %s" % name)
         if not args[1].get('gte'):
             first_created_event = queries._first_created_event(
@@ -239,7 +248,7 @@ class ELmonocleDB:
                 args[1]['gte'] = None
         if not args[1].get('lte'):
             args[1]['lte'] = int(datetime.now().timestamp() * 1000)
-        return getattr(queries, name)(self.es, self.index, *args, **kwargs)
+        return query(self.es, self.index, *args, **kwargs)
 
     def get_indices(self):
         return [
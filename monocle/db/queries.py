@@ -15,13 +15,14 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import re
 
-import statistics
-from copy import deepcopy
-from datetime import datetime
-from itertools import groupby
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from functools import partial
 from itertools import chain
-from monocle.utils import dbdate_to_datetime
+from itertools import islice
 from monocle.utils import enhance_changes
 from monocle.utils import Detector
 
@@ -30,6 +31,8 @@ from elasticsearch.exceptions import NotFoundError
 
 log = logging.getLogger(__name__)
 
+executor = ThreadPoolExecutor(max_workers=8)
+
 public_queries = (
     "count_events",
     "count_authors",
@@ -113,32 +116,86 @@ def generate_changes_filter(params, qfilter):
             )
 
 
-def generate_filter(repository_fullname, params):
-    gte = params.get('gte')
-    lte = params.get('lte')
-    etype = params.get('etype')
-    authors = params.get('authors')
-    on_authors = params.get('on_authors')
-    approvals = params.get('approvals')
-    exclude_approvals = params.get('exclude_approvals')
-    exclude_authors = params.get('exclude_authors')
+# Lucene regexp operators. Repository entries without them are plain names
+# that can be matched with a terms filter instead of a costly regexp query.
+REGEX_META = re.compile(r'[.?+*|{}\[\]()"\\#@&<>~^$]')
+# Operators that can hold a '|' not meant as a top level alternation
+REGEX_GROUPING = re.compile(r'[{}\[\]()"\\]')
+# Below the default index.max_terms_count (65536)
+MAX_TERMS_COUNT = 10000
+
+
+def repository_filter(repository_fullname):
+    entries = [repository_fullname]
+    if not REGEX_GROUPING.search(repository_fullname):
+        entries = repository_fullname.split('|')
+    literals = [entry for entry in entries if not REGEX_META.search(entry)]
+    clauses = []
+    if literals:
+        clauses.append({"terms": {"repository_fullname": literals}})
+    for entry in entries:
+        if REGEX_META.search(entry):
+            clauses.append({"regexp": {"repository_fullname": {"value": entry}}})
+    if len(clauses) == 1:
+        return clauses[0]
+    # Wrap the compound clause so it is cached as a single filter
+    return {
+        "constant_score": {
+            "filter": {"bool": {"should": clauses, "minimum_should_match": 1}}
+        }
+    }
+
+
+def _to_tuple(value):
+    return tuple(value) if value else None
+
+
+@lru_cache(maxsize=256)
+def _build_filter_skeleton(
+    repository_fullname, gte, lte, authors, on_authors, exclude_authors
+):
+    # Filter clauses that do not depend on the event type. The per etype
+    # sweeps only change etype/state so this part is built once and cached.
+    # Returned clauses are shared between calls and must not be mutated.
     created_at_range = {"created_at": {"format": "epoch_millis"}}
-    change_ids = params.get('change_ids')
-    target_branch = params.get('target_branch')
-    files = params.get('files')
     if gte:
         created_at_range['created_at']['gte'] = gte
     if lte:
         created_at_range['created_at']['lte'] = lte
     qfilter = [
-        {"regexp": {"repository_fullname": {"value": repository_fullname}}},
+        repository_filter(repository_fullname),
         {"range": created_at_range},
     ]
-    qfilter.append({"terms": {"type": etype}})
     if authors:
         qfilter.append({"terms": {"author": authors}})
     if on_authors:
         qfilter.append({"terms": {"on_author": on_authors}})
+    must_not = []
+    if exclude_authors:
+        must_not.append({"terms": {"author": exclude_authors}})
+        must_not.append({"terms": {"on_author": exclude_authors}})
+    return tuple(qfilter), tuple(must_not)
+
+
+def generate_filter(repository_fullname, params):
+    etype = params.get('etype')
+    approvals = params.get('approvals')
+    exclude_approvals = params.get('exclude_approvals')
+    exclude_change_ids = params.get('exclude_change_ids')
+    change_ids = params.get('change_ids')
+    target_branch = params.get('target_branch')
+    files = params.get('files')
+    qfilter, must_not = _build_filter_skeleton(
+        repository_fullname,
+        params.get('gte'),
+        params.get('lte'),
+        _to_tuple(params.get('authors')),
+        _to_tuple(params.get('on_authors')),
+        _to_tuple(params.get('exclude_authors')),
+    )
+    qfilter = list(qfilter)
+    must_not = list(must_not)
+    qfilter.append({"terms": {"type": etype}})
     if change_ids:
         qfilter.append({"terms": {"change_id": change_ids}})
     if target_branch:
@@ -152,12 +209,14 @@ def generate_filter(repository_fullname, params):
     if approvals:
         qfilter.append({'terms': {"approval": approvals}})
 
-    must_not = []
-    if exclude_authors:
-        must_not.append({"terms": {"author": exclude_authors}})
-        must_not.append({"terms": {"on_author": exclude_authors}})
     if exclude_approvals:
         must_not.append({"terms": {"approval": exclude_approvals}})
+    if exclude_change_ids:
+        # Split large lists to stay under the index.max_terms_count limit
+        # of a single terms query
+        for start in range(0, len(exclude_change_ids), MAX_TERMS_COUNT):
+            end = start + MAX_TERMS_COUNT
+            must_not.append({"terms": {"change_id": exclude_change_ids[start:end]}})
 
     ret = {"bool": {"filter": qfilter, "must_not": must_not}}
     log.debug("query EL filter: %s" % ret)
@@ -165,17 +224,28 @@ def generate_filter(repository_fullname, params):
 
 
 def switch_to_on_authors(params):
+    params = dict(params)
     if params.get('authors'):
         # We want the events happening on changes authored by the selected authors
-        params['on_authors'] = params.get('authors')
-        del params['authors']
-        if 'exclude_authors' in params:
-            # We don't want to exclude any events authors in that context
-            del params['exclude_authors']
+        params['on_authors'] = params.pop('authors')
+        # We don't want to exclude any events authors in that context
+        params.pop('exclude_authors', None)
+    return params
+
+
+class MsearchError(Exception):
+    pass
 
 
-def run_query(es, index, body):
+# Response filters to only get the parts of the results we read
+AGGS_FILTER_PATH = "aggregations,hits.total"
+HITS_FILTER_PATH = "hits.hits._source,hits.total"
+
+
+def run_query(es, index, body, filter_path=None):
     search_params = {'index': index, 'doc_type': index, 'body': body}
+    if filter_path:
+        search_params['filter_path'] = filter_path
     try:
         log.debug('run_query "%s"' % search_params)
         res = es.search(**search_params)
@@ -187,30 +257,71 @@ def run_query(es, index, body):
     return res
 
 
+def run_msearch(es, index, bodies, filter_path=None):
+    # Send independent searches in a single round-trip and return the
+    # responses in the same order as the bodies
+    lines = []
+    for body in bodies:
+        lines.append({})
+        lines.append(body)
+    search_params = {'index': index, 'doc_type': index, 'body': lines}
+    if filter_path:
+        search_params['filter_path'] = ','.join(
+            'responses.%s' % path
+            for path in filter_path.split(',') + ['error', 'status']
+        )
+    # Unlike run_query, fail loudly: the callers index the responses by
+    # position and a missing or partial result would be silently wrong
+    try:
+        log.debug('run_msearch "%s"' % search_params)
+        res = es.msearch(**search_params)
+    except NotFoundError:
+        raise
+    except Exception as excpt:
+        raise MsearchError('Unable to run msearch: %s' % excpt) from excpt
+    for pos, response in enumerate(res['responses']):
+        if 'error' in response:
+            if response.get('status') == 404:
+                raise NotFoundError(404, response['error'])
+            raise MsearchError(
+                'Unable to run msearch body %d: %s' % (pos, response['error'])
+            )
+    return res['responses']
+
+
+def run_concurrently(es, index, repository_fullname, params, queries):
+    # Run independent queries (name -> function) in the shared thread pool
+    # and return their results by name. The pool size bounds the number of
+    # searches sent in parallel to ES. The queries must not mutate params
+    # and must not use the pool themselves.
+    futures = {
+        name: executor.submit(query, es, index, repository_fullname, params)
+        for name, query in queries.items()
+    }
+    return {name: future.result() for name, future in futures.items()}
+
+
 def _scan(es, index, repository_fullname, params):
     body = {
         # "_source": "change_id",
         "_source": params.get('field', []),
         "query": generate_filter(repository_fullname, params),
     }
+    size = params.get('size')
     scanner_params = {'index': index, 'doc_type': index, 'query': body}
     data = scanner(es, **scanner_params)
-    ret = []
-    size = params.get('size')
-    for d in data:
-        if size and len(ret) == size:
-            break
-        ret.append(d['_source'])
-    return ret
+    # Stream the hits to the caller instead of loading them all in memory
+    yield from (d['_source'] for d in islice(data, size or None))
 
 
 def _first_created_event(es, index, repository_fullname, params):
     body = {
+        "size": 1,
         "sort": [{"created_at": {"order": "asc"}}],
         "query": generate_filter(repository_fullname, params),
     }
-    data = run_query(es, index, body)
-    data = [r['_source'] for r in data['hits']['hits']]
+    data = run_query(es, index, body, filter_path="hits.hits._source.created_at")
+    data = [r['_source'] for r in data.get('hits', {}).get('hits', [])]
     if data:
         return data[0]['created_at']
 
@@ -223,15 +334,19 @@ def count_events(es, index, repository_fullname, params):
     return res['count']
 
 
-def count_authors(es, index, repository_fullname, params):
-    body = {
+def _count_authors_body(repository_fullname, params):
+    return {
         "aggs": {
             "agg1": {"cardinality": {"field": "author", "precision_threshold": 3000}}
         },
         "size": 0,
         "query": generate_filter(repository_fullname, params),
     }
-    data = run_query(es, index, body)
+
+
+def count_authors(es, index, repository_fullname, params):
+    body = _count_authors_body(repository_fullname, params)
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
     return data['aggregations']['agg1']['value']
 
 
@@ -263,7 +378,7 @@ def interval_to_format(interval):
     return 'yyyy-MM-dd HH:mm'
 
 
-def events_histo(es, index, repository_fullname, params):
+def _events_histo_body(repository_fullname, params):
     duration = (params['lte'] - params['gte']) / 1000
     interval = set_histo_granularity(duration)
     fmt = interval_to_format(interval)
@@ -284,13 +399,22 @@ def events_histo(es, index, repository_fullname, params):
         "size": 0,
         "query": generate_filter(repository_fullname, params),
     }
-    data = run_query(es, index, body)
+    return body
+
+
+def _events_histo_result(data):
     return (
         data['aggregations']['agg1']['buckets'],
         data['aggregations']['avg_count']['value'] or 0,
     )
 
 
+def events_histo(es, index, repository_fullname, params):
+    body = _events_histo_body(repository_fullname, params)
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
+    return _events_histo_result(data)
+
+
 def authors_histo(es, index, repository_fullname, params):
     duration = (params['lte'] - params['gte']) / 1000
     interval = set_histo_granularity(duration)
@@ -313,7 +437,7 @@ def authors_histo(es, index, repository_fullname, params):
         "size": 0,
         "query": generate_filter(repository_fullname, params),
     }
-    data = run_query(es, index, body)
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
     res = data["aggregations"]["agg1"]["buckets"]
     for bucket in res:
         bucket['authors'] = [b['key'] for b in bucket['authors']['buckets']]
@@ -324,7 +448,7 @@ def authors_histo(es, index, repository_fullname, params):
     return {'buckets': res, 'avg_authors': avg, 'total_authors': total}
 
 
-def _events_top(es, index, repository_fullname, field, params):
+def _events_top_body(repository_fullname, field, params):
     body = {
         "aggs": {
             "agg1": {
@@ -334,13 +458,18 @@ def _events_top(es, index, repository_fullname, field, params):
         "size": 0,
         "query": generate_filter(repository_fullname, params),
     }
-    data = run_query(es, index, body)
-    count_series = [b['doc_count'] for b in data['aggregations']['agg1']['buckets']]
-    count_avg = statistics.mean(count_series) if count_series else 0
-    count_median = statistics.median(sorted(count_series)) if count_series else 0
+    return body
+
+
+def _events_top_result(data, params):
+    buckets = data['aggregations']['agg1']['buckets']
+    count_series = np.fromiter(
+        (b['doc_count'] for b in buckets), dtype=np.int64, count=len(buckets)
+    )
+    count_avg = float(count_series.mean()) if count_series.size else 0
+    count_median = float(np.median(count_series)) if count_series.size else 0
     _from = params['from']
     _to = params['from'] + params['size']
-    buckets = data['aggregations']['agg1']['buckets']
     return {
         'items': buckets[_from:_to],
         'count_avg': count_avg,
@@ -350,9 +479,14 @@ def _events_top(es, index, repository_fullname, field, params):
     }
 
 
+def _events_top(es, index, repository_fullname, field, params):
+    body = _events_top_body(repository_fullname, field, params)
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
+    return _events_top_result(data, params)
+
+
 def repos_top(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
+    params = {**params, 'etype': ("Change",)}
     return _events_top(es, index, repository_fullname, "repository_fullname", params)
 
 
@@ -362,57 +496,72 @@ def events_top_authors(es, index, repository_fullname, params):
 
 # TODO(fbo): add tests for queries below
 def changes_top_approval(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("ChangeReviewedEvent",)
+    params = {**params, 'etype': ("ChangeReviewedEvent",)}
     return _events_top(es, index, repository_fullname, "approval", params)
 
 
 def changes_top_commented(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("ChangeCommentedEvent",)
+    params = {**params, 'etype': ("ChangeCommentedEvent",)}
     return _events_top(es, index, repository_fullname, "change_id", params)
 
 
 def changes_top_reviewed(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("ChangeReviewedEvent",)
+    params = {**params, 'etype': ("ChangeReviewedEvent",)}
     return _events_top(es, index, repository_fullname, "change_id", params)
 
 
 def authors_top_reviewed(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("ChangeReviewedEvent",)
+    params = {**params, 'etype': ("ChangeReviewedEvent",)}
     return _events_top(es, index, repository_fullname, "on_author", params)
 
 
 def authors_top_commented(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("ChangeCommentedEvent",)
+    params = {**params, 'etype': ("ChangeCommentedEvent",)}
     return _events_top(es, index, repository_fullname, "on_author", params)
 
 
 def authors_top(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
+    params = {**params, 'etype': ("Change",)}
     return _events_top(es, index, repository_fullname, "author", params)
 
 
 def peers_exchange_strength(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("ChangeReviewedEvent", "ChangeCommentedEvent")
-    # Fetch the most active authors for those events
-    authors = [
-        bucket['key']
-        for bucket in _events_top(es, index, repository_fullname, "author", params)[
-            'items'
-        ]
-    ]
+    params = {**params, 'etype': ("ChangeReviewedEvent", "ChangeCommentedEvent")}
+    _from = params['from']
+    _to = params['from'] + params['size']
+    # Fetch the most active authors for those events and, for each of them,
+    # the authors they most review or comment
+    body = {
+        "aggs": {
+            "agg1": {
+                "terms": {
+                    "field": "author",
+                    "size": _to,
+                    # Collect a deep enough set of authors per shard, as the
+                    # 1000 buckets queries did, so that the counts are accurate
+                    "shard_size": max(_to, 1000),
+                    "order": {"_count": "desc"},
+                },
+                "aggs": {
+                    "agg2": {
+                        "terms": {
+                            "field": "on_author",
+                            "size": _to,
+                            "shard_size": max(_to, 1000),
+                            "order": {"_count": "desc"},
+                        }
+                    }
+                },
+            }
+        },
+        "size": 0,
+        "query": generate_filter(repository_fullname, params),
+    }
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
     peers_strength = {}
-    # For each of them get authors they most review or comment
-    for author in authors:
-        params['authors'] = [author]
-        ret = _events_top(es, index, repository_fullname, "on_author", params)['items']
-        for bucket in ret:
+    for author_bucket in data['aggregations']['agg1']['buckets'][_from:_to]:
+        author = author_bucket['key']
+        for bucket in author_bucket['agg2']['buckets'][_from:_to]:
             if bucket['key'] == author:
                 continue
             # Build a peer identifier
@@ -429,9 +578,7 @@ def peers_exchange_strength(es, index, repository_fullname, params):
 
 
 def change_merged_count_by_duration(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
-    params['state'] = "MERGED"
+    params = {**params, 'etype': ("Change",), 'state': "MERGED"}
     body = {
         "aggs": {
             "agg1": {
@@ -450,83 +597,106 @@ def change_merged_count_by_duration(es, index, repository_fullname, params):
         "size": 0,
         "query": generate_filter(repository_fullname, params),
     }
-    data = run_query(es, index, body)
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
     return data['aggregations']['agg1']['buckets']
 
 
 def change_merged_avg_duration(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
-    params['state'] = "MERGED"
+    params = {**params, 'etype': ("Change",), 'state': "MERGED"}
     body = {
         "aggs": {"agg1": {"avg": {"field": "duration"}}},
         "size": 0,
         "docvalue_fields": [{"field": "created_at", "format": "date_time"}],
         "query": generate_filter(repository_fullname, params),
     }
-    data = run_query(es, index, body)
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
     return data['aggregations']['agg1']['value']
 
 
 def change_merged_avg_commits(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
-    params['state'] = "MERGED"
+    params = {**params, 'etype': ("Change",), 'state': "MERGED"}
     body = {
         "aggs": {"agg1": {"avg": {"field": "commit_count"}}},
         "size": 0,
         "docvalue_fields": [{"field": "created_at", "format": "date_time"}],
         "query": generate_filter(repository_fullname, params),
     }
-    data = run_query(es, index, body)
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
     return data['aggregations']['agg1']['value']
 
 
 def changes_with_tests_ratio(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
-    all = count_events(es, index, repository_fullname, params)
+    params = {**params, 'etype': ("Change",)}
+    # Count all the changes and the ones including tests in the same search
+    body = {
+        "aggs": {
+            "agg1": {
+                "filter": {
+                    "regexp": {"changed_files.path": {'value': Detector.tests_regexp}}
+                }
+            }
+        },
+        "size": 0,
+        "query": generate_filter(repository_fullname, params),
+    }
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
+    all = data['hits']['total']
     if all == 0:
         return 0
-    params['tests_included'] = True
-    tests = count_events(es, index, repository_fullname, params)
+    tests = data['aggregations']['agg1']['doc_count']
     return round(tests / all * 100, 1)
 
 
+def _count_changes_by_state(es, index, repository_fullname, params):
+    params = {**params, 'etype': ("Change",), 'state': None}
+    body = {
+        "aggs": {"agg1": {"terms": {"field": "state"}}},
+        "size": 0,
+        "query": generate_filter(repository_fullname, params),
+    }
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
+    return {b['key']: b['doc_count'] for b in data['aggregations']['agg1']['buckets']}
+
+
 def count_opened_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
-    params['state'] = "OPEN"
+    params = {**params, 'etype': ("Change",), 'state': "OPEN"}
     return count_events(es, index, repository_fullname, params)
 
 
 def count_merged_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
-    params['state'] = "MERGED"
+    params = {**params, 'etype': ("Change",), 'state': "MERGED"}
     return count_events(es, index, repository_fullname, params)
 
 
 def count_abandoned_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
-    params['state'] = "CLOSED"
+    params = {**params, 'etype': ("Change",), 'state': "CLOSED"}
     return count_events(es, index, repository_fullname, params)
 
 
 def changes_closed_ratios(es, index, repository_fullname, params):
-    params = deepcopy(params)
+    params = dict(params)
     etypes = (
         'ChangeCreatedEvent',
         "ChangeCommitPushedEvent",
         "ChangeCommitForcePushedEvent",
     )
-    ret = {}
+    bodies = []
     for etype in etypes:
         params['etype'] = (etype,)
-        ret[etype] = count_events(es, index, repository_fullname, params)
-    changes_merged = count_merged_changes(es, index, repository_fullname, params)
-    changes_abandoned = count_abandoned_changes(es, index, repository_fullname, params)
+        bodies.append(
+            {"size": 0, "query": generate_filter(repository_fullname, params)}
+        )
+    params['etype'] = ("Change",)
+    for state in ("MERGED", "CLOSED"):
+        params['state'] = state
+        bodies.append(
+            {"size": 0, "query": generate_filter(repository_fullname, params)}
+        )
+    responses = run_msearch(es, index, bodies, filter_path=AGGS_FILTER_PATH)
+    counts = [response['hits']['total'] for response in responses]
+    changes_abandoned = counts.pop()
+    changes_merged = counts.pop()
+    ret = dict(zip(etypes, counts))
     try:
         ret['merged/created'] = round(
             changes_merged / ret['ChangeCreatedEvent'] * 100, 1
@@ -554,42 +724,49 @@ def changes_closed_ratios(es, index, repository_fullname, params):
 
 
 def _first_event_on_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
-
-    def keyfunc(x):
-        return x['change_id']
-
-    groups = {}
-    _events = _scan(es, index, repository_fullname, params)
-    _events = sorted(_events, key=lambda k: k['change_id'])
-    # Keep by Change the created date + first event date
-    for pr, events in groupby(_events, keyfunc):
-        groups[pr] = {
-            'change_created_at': None,
-            'first_event_created_at': datetime.now(),
-            'first_event_author': None,
-            'delta': None,
-        }
-        for event in events:
-            if not groups[pr]['change_created_at']:
-                groups[pr]['change_created_at'] = dbdate_to_datetime(
-                    event['on_created_at']
-                )
-            event_created_at = dbdate_to_datetime(event['created_at'])
-            if event_created_at < groups[pr]['first_event_created_at']:
-                groups[pr]['first_event_created_at'] = event_created_at
-                groups[pr]['delta'] = (
-                    groups[pr]['first_event_created_at']
-                    - groups[pr]['change_created_at']
-                )
-                groups[pr]['first_event_author'] = event['author']
+    # Let ES keep the first event of each change instead of fetching them all
+    body = {
+        "aggs": {
+            "agg1": {
+                # Order by key so that, past the size, the sample of changes
+                # does not favor the changes with the most events
+                "terms": {
+                    "field": "change_id",
+                    "size": params['size'],
+                    "order": {"_key": "asc"},
+                },
+                "aggs": {
+                    "first_event": {
+                        "top_hits": {
+                            "size": 1,
+                            "sort": [{"created_at": {"order": "asc"}}],
+                            "_source": {"includes": ["author"]},
+                            # Get the dates as epoch in ms to avoid parsing them
+                            "docvalue_fields": [
+                                {"field": "created_at", "format": "epoch_millis"},
+                                {"field": "on_created_at", "format": "epoch_millis"},
+                            ],
+                        }
+                    }
+                },
+            }
+        },
+        "size": 0,
+        "query": generate_filter(repository_fullname, params),
+    }
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
+    buckets = data['aggregations']['agg1']['buckets']
     ret = {'first_event_delay_avg': 0, 'top_authors': {}}
-    for pr_data in groups.values():
-        ret['first_event_delay_avg'] += pr_data['delta'].seconds
-        ret['top_authors'].setdefault(pr_data['first_event_author'], 0)
-        ret['top_authors'][pr_data['first_event_author']] += 1
+    for bucket in buckets:
+        event = bucket['first_event']['hits']['hits'][0]
+        created_at = int(event['fields']['created_at'][0])
+        on_created_at = int(event['fields']['on_created_at'][0])
+        ret['first_event_delay_avg'] += (created_at - on_created_at) // 1000
+        author = event['_source']['author']
+        ret['top_authors'].setdefault(author, 0)
+        ret['top_authors'][author] += 1
     try:
-        ret['first_event_delay_avg'] = int(ret['first_event_delay_avg'] / len(groups))
+        ret['first_event_delay_avg'] = int(ret['first_event_delay_avg'] / len(buckets))
     except ZeroDivisionError:
         ret['first_event_delay_avg'] = 0
     ret['top_authors'] = sorted(
@@ -601,71 +778,121 @@ def _first_event_on_changes(es, index, repository_fullname, params):
 
 
 def first_comment_on_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ('ChangeCommentedEvent',)
-    # limit the depth of the scan query as this query is expensive
-    params['size'] = 10000
+    # limit the number of changes as this query is expensive, the result is
+    # computed on the first 10000 changes by change_id
+    params = {**params, 'etype': ('ChangeCommentedEvent',), 'size': 10000}
     return _first_event_on_changes(es, index, repository_fullname, params)
 
 
 def first_review_on_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ('ChangeReviewedEvent',)
-    # limit the depth of the scan query as this query is expensive
-    params['size'] = 10000
+    # limit the number of changes as this query is expensive, the result is
+    # computed on the first 10000 changes by change_id
+    params = {**params, 'etype': ('ChangeReviewedEvent',), 'size': 10000}
     return _first_event_on_changes(es, index, repository_fullname, params)
 
 
 def cold_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
+    params = dict(params)
     size = params.get('size')
+    # Collect the ids of the changes that got a comment or a review. Page
+    # through them with a composite aggregation to not miss any of them.
+    params['etype'] = ('ChangeCommentedEvent', 'ChangeReviewedEvent')
+    body = {
+        "aggs": {
+            "agg1": {
+                "composite": {
+                    "sources": [{"change_id": {"terms": {"field": "change_id"}}}],
+                    "size": 10000,
+                }
+            }
+        },
+        "size": 0,
+        "query": generate_filter(repository_fullname, params),
+    }
+    change_ids = []
+    while True:
+        data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
+        # filter_path drops the empty buckets list of the last page
+        agg = data.get('aggregations', {}).get('agg1', {})
+        buckets = agg.get('buckets', [])
+        change_ids.extend(b['key']['change_id'] for b in buckets)
+        if not buckets or 'after_key' not in agg:
+            break
+        body['aggs']['agg1']['composite']['after'] = agg['after_key']
+    params['exclude_change_ids'] = change_ids
+    # Then fetch the oldest open changes excluding them
     params['etype'] = ('Change',)
     params['state'] = 'OPEN'
-    changes = _scan(es, index, repository_fullname, params)
-    _changes_ids = set([change['change_id'] for change in changes])
-    params['etype'] = ('ChangeCommentedEvent', 'ChangeReviewedEvent')
-    del params['state']
-    events = _scan(es, index, repository_fullname, params)
-    _events_ids = set([event['change_id'] for event in events])
-    changes_ids_wo_rc = _changes_ids.difference(_events_ids)
-    changes_wo_rc = [
-        change for change in changes if change['change_id'] in changes_ids_wo_rc
-    ]
-    changes_wo_rc = enhance_changes(changes_wo_rc)
-    items = sorted(changes_wo_rc, key=lambda x: dbdate_to_datetime(x['created_at']))
-    if size:
-        items = items[:size]
-    return {'items': items}
+    body = {
+        "sort": [{"created_at": {"order": "asc"}}],
+        "size": size or 10000,
+        "query": generate_filter(repository_fullname, params),
+    }
+    data = run_query(es, index, body, filter_path=HITS_FILTER_PATH)
+    changes = [r['_source'] for r in data['hits'].get('hits', [])]
+    return {'items': enhance_changes(changes)}
+
+
+# Number of commented changes used to compute the comments average
+HOT_CHANGES_DEPTH = 1000
+# Number of most commented changes that can be reported as hot
+HOT_CHANGES_CANDIDATES = 500
 
 
 def hot_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
+    params = dict(params)
     size = params.get('size')
-    # Set a significant depth to get an 'accurate' average value
-    params['size'] = 500
-    top_commented_changes = changes_top_commented(
-        es, index, repository_fullname, params
-    )
-    # Keep changes with comment events > average
-    top_commented_changes = [
-        change
-        for change in top_commented_changes['items']
-        if change['doc_count'] > top_commented_changes['count_avg']
+    params['etype'] = ('ChangeCommentedEvent',)
+    change_params = {'etype': ('Change',), 'state': 'OPEN'}
+    # Fetch in one query the comments count and the open change doc by change
+    body = {
+        "aggs": {
+            "agg1": {
+                "terms": {
+                    "field": "change_id",
+                    # Average the comments over more changes than the
+                    # candidates to get an 'accurate' value
+                    "size": HOT_CHANGES_DEPTH,
+                    "order": {"comments": "desc"},
+                },
+                "aggs": {
+                    "comments": {"filter": {"term": {"type": "ChangeCommentedEvent"}}},
+                    "change": {
+                        "filter": {"term": {"type": "Change"}},
+                        "aggs": {"doc": {"top_hits": {"size": 1}}},
+                    },
+                },
+            }
+        },
+        "size": 0,
+        "query": {
+            "bool": {
+                "should": [
+                    generate_filter(repository_fullname, params),
+                    generate_filter(repository_fullname, change_params),
+                ],
+                "minimum_should_match": 1,
+            }
+        },
+    }
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
+    buckets = [
+        bucket
+        for bucket in data['aggregations']['agg1']['buckets']
+        if bucket['comments']['doc_count']
     ]
-    mapping = {}
-    for top_commented_change in top_commented_changes:
-        mapping[top_commented_change['key']] = top_commented_change['doc_count']
-    change_ids = [_id['key'] for _id in top_commented_changes]
-    if not change_ids:
+    if not buckets:
         return {'items': []}
-    _params = {
-        'etype': ('Change',),
-        'state': 'OPEN',
-        'change_ids': change_ids,
-    }
-    changes = _scan(es, index, repository_fullname, _params)
-    for change in changes:
-        change['hot_score'] = mapping[change['change_id']]
+    count_avg = np.mean([b['comments']['doc_count'] for b in buckets])
+    # Keep the most commented open changes with comment events > average
+    changes = [
+        dict(
+            bucket['change']['doc']['hits']['hits'][0]['_source'],
+            hot_score=bucket['comments']['doc_count'],
+        )
+        for bucket in buckets[:HOT_CHANGES_CANDIDATES]
+        if bucket['comments']['doc_count'] > count_avg and bucket['change']['doc_count']
+    ]
     changes = enhance_changes(changes)
     items = sorted(changes, key=lambda x: x['hot_score'], reverse=True)
     if size:
@@ -674,8 +901,7 @@ def hot_changes(es, index, repository_fullname, params):
 
 
 def changes_lifecycle_histos(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    switch_to_on_authors(params)
+    params = switch_to_on_authors(params)
     ret = {}
     etypes = (
         'ChangeCreatedEvent',
@@ -684,38 +910,63 @@ def changes_lifecycle_histos(es, index, repository_fullname, params):
         "ChangeCommitPushedEvent",
         "ChangeCommitForcePushedEvent",
     )
+    bodies = []
     for etype in etypes:
         params['etype'] = (etype,)
-        ret[etype] = events_histo(es, index, repository_fullname, params)
+        bodies.append(_events_histo_body(repository_fullname, params))
+    responses = run_msearch(es, index, bodies, filter_path=AGGS_FILTER_PATH)
+    for etype, data in zip(etypes, responses):
+        ret[etype] = _events_histo_result(data)
     return ret
 
 
-def changes_lifecycle_stats(es, index, repository_fullname, params):
-    params = deepcopy(params)
+def _events_and_authors_counts(es, index, repository_fullname, params, etypes):
+    params = dict(params)
+    bodies = []
+    for etype in etypes:
+        params['etype'] = (etype,)
+        bodies.append(_count_authors_body(repository_fullname, params))
+    responses = run_msearch(es, index, bodies, filter_path=AGGS_FILTER_PATH)
     ret = {}
-    ret['ratios'] = changes_closed_ratios(es, index, repository_fullname, params)
-    ret['histos'] = changes_lifecycle_histos(es, index, repository_fullname, params)
-    ret['duration'] = change_merged_avg_duration(es, index, repository_fullname, params)
-    ret['commits'] = change_merged_avg_commits(es, index, repository_fullname, params)
-    ret['tests'] = changes_with_tests_ratio(es, index, repository_fullname, params)
-    ret['opened'] = count_opened_changes(es, index, repository_fullname, params)
-    ret['merged'] = count_merged_changes(es, index, repository_fullname, params)
-    ret['abandoned'] = count_abandoned_changes(es, index, repository_fullname, params)
+    for etype, data in zip(etypes, responses):
+        ret[etype] = {
+            'events_count': data['hits']['total'],
+            'authors_count': data['aggregations']['agg1']['value'],
+        }
+    return ret
+
+
+def changes_lifecycle_stats(es, index, repository_fullname, params):
     etypes = (
         'ChangeCreatedEvent',
         "ChangeCommitPushedEvent",
         "ChangeCommitForcePushedEvent",
     )
-    for etype in etypes:
-        params['etype'] = (etype,)
-        events_count = count_events(es, index, repository_fullname, params)
-        authors_count = count_authors(es, index, repository_fullname, params)
-        ret[etype] = {'events_count': events_count, 'authors_count': authors_count}
+    ret = run_concurrently(
+        es,
+        index,
+        repository_fullname,
+        params,
+        {
+            'ratios': changes_closed_ratios,
+            'histos': changes_lifecycle_histos,
+            'duration': change_merged_avg_duration,
+            'commits': change_merged_avg_commits,
+            'tests': changes_with_tests_ratio,
+            'by_state': _count_changes_by_state,
+            'counts': partial(_events_and_authors_counts, etypes=etypes),
+        },
+    )
+    by_state = ret.pop('by_state')
+    ret['opened'] = by_state.get('OPEN', 0)
+    ret['merged'] = by_state.get('MERGED', 0)
+    ret['abandoned'] = by_state.get('CLOSED', 0)
+    ret.update(ret.pop('counts'))
     return ret
 
 
 def authors_histo_stats(es, index, repository_fullname, params):
-    params = deepcopy(params)
+    params = dict(params)
     ret = {}
     etypes = (
         'ChangeCreatedEvent',
@@ -729,45 +980,57 @@ def authors_histo_stats(es, index, repository_fullname, params):
 
 
 def changes_review_histos(es, index, repository_fullname, params):
-    params = deepcopy(params)
+    params = dict(params)
     ret = {}
     etypes = ('ChangeCommentedEvent', "ChangeReviewedEvent")
+    bodies = []
     for etype in etypes:
         params['etype'] = (etype,)
-        ret[etype] = events_histo(es, index, repository_fullname, params)
+        bodies.append(_events_histo_body(repository_fullname, params))
+    responses = run_msearch(es, index, bodies, filter_path=AGGS_FILTER_PATH)
+    for etype, data in zip(etypes, responses):
+        ret[etype] = _events_histo_result(data)
     return ret
 
 
 def changes_review_stats(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    ret = {}
-    ret['first_event_delay'] = {}
-    ret['first_event_delay']['comment'] = first_comment_on_changes(
-        es, index, repository_fullname, params
-    )
-    ret['first_event_delay']['review'] = first_review_on_changes(
-        es, index, repository_fullname, params
+    etypes = ("ChangeReviewedEvent", "ChangeCommentedEvent")
+    ret = run_concurrently(
+        es,
+        index,
+        repository_fullname,
+        params,
+        {
+            'comment': first_comment_on_changes,
+            'review': first_review_on_changes,
+            'histos': changes_review_histos,
+            'counts': partial(_events_and_authors_counts, etypes=etypes),
+        },
     )
-    ret['histos'] = changes_review_histos(es, index, repository_fullname, params)
-    for etype in ("ChangeReviewedEvent", "ChangeCommentedEvent"):
-        params['etype'] = (etype,)
-        events_count = count_events(es, index, repository_fullname, params)
-        authors_count = count_authors(es, index, repository_fullname, params)
-        ret[etype] = {'events_count': events_count, 'authors_count': authors_count}
+    ret['first_event_delay'] = {
+        'comment': ret.pop('comment'),
+        'review': ret.pop('review'),
+    }
+    ret.update(ret.pop('counts'))
     return ret
 
 
 def most_active_authors_stats(es, index, repository_fullname, params):
-    params = deepcopy(params)
+    params = dict(params)
     ret = {}
+    keys = []
+    bodies = []
     for etype in ("ChangeCreatedEvent", "ChangeReviewedEvent", "ChangeCommentedEvent"):
         params['etype'] = (etype,)
-        ret[etype] = events_top_authors(es, index, repository_fullname, params)
+        keys.append(etype)
+        bodies.append(_events_top_body(repository_fullname, "author", params))
     params['etype'] = ("Change",)
     params['state'] = 'MERGED'
-    ret["ChangeMergedEvent"] = events_top_authors(
-        es, index, repository_fullname, params
-    )
+    keys.append("ChangeMergedEvent")
+    bodies.append(_events_top_body(repository_fullname, "author", params))
+    responses = run_msearch(es, index, bodies, filter_path=AGGS_FILTER_PATH)
+    for key, data in zip(keys, responses):
+        ret[key] = _events_top_result(data, params)
     return ret
 
 
@@ -784,106 +1047,145 @@ def params_to_datefield(params):
     return "closed_at"
 
 
-def last_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
+def _parse_search_after(token):
+    # The token is the "<date sort value>,<id>" returned with the previous page
+    if not token:
+        return None
+    sort_value, _, _id = token.partition(',')
+    if not sort_value.lstrip('-').isdigit() or not _id:
+        log.warning('Ignoring invalid search_after token "%s"' % token)
+        return None
+    return [int(sort_value), _id]
+
+
+def _sorted_items(es, index, repository_fullname, params, datefield, order):
+    # The total can be skipped when the caller does not display it, which
+    # saves counting all the matching documents on large indices
+    track_total_hits = params.get('track_total_hits', True)
     body = {
-        "sort": [{params_to_datefield(params): {"order": "desc"}}],
+        # Sort by id to break ties so that search_after pagination is stable
+        "sort": [{datefield: {"order": order}}, {"id": {"order": "asc"}}],
         "size": params['size'],
-        "from": params['from'],
+        "track_total_hits": track_total_hits,
         "query": generate_filter(repository_fullname, params),
     }
-    data = run_query(es, index, body)
-    changes = [r['_source'] for r in data['hits']['hits']]
-    changes = enhance_changes(changes)
-    return {'items': changes, 'total': data['hits']['total']}
+    search_after = _parse_search_after(params.get('search_after'))
+    if search_after:
+        # Resume after the last item of the previous page instead of
+        # having each shard collect and skip the 'from' first hits
+        body['search_after'] = search_after
+    else:
+        body['from'] = params['from']
+    data = run_query(es, index, body, filter_path=HITS_FILTER_PATH + ",hits.hits.sort")
+    hits = data.get('hits', {}).get('hits', [])
+    ret = {'items': enhance_changes([r['_source'] for r in hits])}
+    if track_total_hits:
+        ret['total'] = data['hits']['total']
+    if hits:
+        ret['search_after'] = '%s,%s' % tuple(hits[-1]['sort'])
+    return ret
+
+
+def last_changes(es, index, repository_fullname, params):
+    params = {**params, 'etype': ("Change",)}
+    return _sorted_items(
+        es, index, repository_fullname, params, params_to_datefield(params), "desc"
+    )
 
 
 def last_merged_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['state'] = 'MERGED'
+    params = {**params, 'state': 'MERGED'}
     return last_changes(es, index, repository_fullname, params)
 
 
 def last_opened_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['state'] = 'OPEN'
+    params = {**params, 'state': 'OPEN'}
     return last_changes(es, index, repository_fullname, params)
 
 
 def last_state_changed_changes(es, index, repository_fullname, params):
-    return {
-        "merged_changes": last_merged_changes(es, index, repository_fullname, params),
-        "opened_changes": last_opened_changes(es, index, repository_fullname, params),
-    }
+    return run_concurrently(
+        es,
+        index,
+        repository_fullname,
+        params,
+        {
+            "merged_changes": last_merged_changes,
+            "opened_changes": last_opened_changes,
+        },
+    )
 
 
 def oldest_open_changes(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
-    params['state'] = "OPEN"
-    body = {
-        "sort": [{"created_at": {"order": "asc"}}],
-        "size": params['size'],
-        "from": params['from'],
-        "query": generate_filter(repository_fullname, params),
-    }
-    data = run_query(es, index, body)
-    changes = [r['_source'] for r in data['hits']['hits']]
-    changes = enhance_changes(changes)
-    return {'items': changes, 'total': data['hits']['total']}
+    params = {**params, 'etype': ("Change",), 'state': "OPEN"}
+    return _sorted_items(es, index, repository_fullname, params, "created_at", "asc")
 
 
 def changes_and_events(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = (
-        "Change",
-        'ChangeCreatedEvent',
-        "ChangeMergedEvent",
-        "ChangeAbandonedEvent",
-        "ChangeCommitPushedEvent",
-        "ChangeCommitForcePushedEvent",
-        "ChangeReviewedEvent",
-        "ChangeCommentedEvent",
-    )
-    body = {
-        "sort": [{"created_at": {"order": "asc"}}],
-        "size": params['size'],
-        "from": params['from'],
-        "query": generate_filter(repository_fullname, params),
+    params = {
+        **params,
+        'etype': (
+            "Change",
+            'ChangeCreatedEvent',
+            "ChangeMergedEvent",
+            "ChangeAbandonedEvent",
+            "ChangeCommitPushedEvent",
+            "ChangeCommitForcePushedEvent",
+            "ChangeReviewedEvent",
+            "ChangeCommentedEvent",
+        ),
     }
-    data = run_query(es, index, body)
-    changes = [r['_source'] for r in data['hits']['hits']]
-    changes = enhance_changes(changes)
-    return {'items': changes, 'total': data['hits']['total']}
+    return _sorted_items(es, index, repository_fullname, params, "created_at", "asc")
 
 
 def new_contributors(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['size'] = 10000
-    new_authors = events_top_authors(es, index, repository_fullname, params)['items']
-    new = set([x['key'] for x in new_authors])
-    params['lte'] = params['gte']
-    del params['gte']
-    old = set(
-        [
-            x['key']
-            for x in events_top_authors(es, index, repository_fullname, params)['items']
-        ]
-    )
-    diff = new.difference(old)
-    return {'items': [n for n in new_authors if n['key'] in diff]}
+    gte = params.get('gte')
+    if not gte:
+        return {'items': []}
+    # Look at the whole history up to lte and only keep the authors whose
+    # first event happened after gte
+    params = {**params, 'gte': None}
+    body = {
+        "aggs": {
+            "agg1": {
+                # The bucket_selector only runs on the returned buckets, so
+                # get the most recently seen authors first
+                "terms": {
+                    "field": "author",
+                    "size": 10000,
+                    "order": {"first_seen": "desc"},
+                },
+                "aggs": {
+                    "first_seen": {"min": {"field": "created_at"}},
+                    "new_only": {
+                        "bucket_selector": {
+                            "buckets_path": {"first_seen": "first_seen"},
+                            "script": {
+                                "source": "params.first_seen > params.gte",
+                                "params": {"gte": gte},
+                            },
+                        }
+                    },
+                },
+            }
+        },
+        "size": 0,
+        "query": generate_filter(repository_fullname, params),
+    }
+    data = run_query(es, index, body, filter_path=AGGS_FILTER_PATH)
+    buckets = data.get('aggregations', {}).get('agg1', {}).get('buckets', [])
+    buckets = sorted(buckets, key=lambda b: (-b['doc_count'], b['key']))
+    return {'items': [{'key': b['key'], 'doc_count': b['doc_count']} for b in buckets]}
 
 
 def changes_by_file_map(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
+    params = {**params, 'etype': ("Change",)}
     body = {
         "size": 1000,
         "query": generate_filter(repository_fullname, params),
     }
-    data = run_query(es, index, body)
-    changes = [r['_source'] for r in data['hits']['hits']]
+    data = run_query(es, index, body, filter_path=HITS_FILTER_PATH)
+    changes = [r['_source'] for r in data['hits'].get('hits', [])]
     files = {}
     for change in changes:
         for f in change['changed_files']:
@@ -893,14 +1195,13 @@ def changes_by_file_map(es, index, repository_fullname, params):
 
 
 def authors_by_file_map(es, index, repository_fullname, params):
-    params = deepcopy(params)
-    params['etype'] = ("Change",)
+    params = {**params, 'etype': ("Change",)}
     body = {
         "size": 1000,
         "query": generate_filter(repository_fullname, params),
     }
-    data = run_query(es, index, body)
-    changes = [r['_source'] for r in data['hits']['hits']]
+    data = run_query(es, index, body, filter_path=HITS_FILTER_PATH)
+    changes = [r['_source'] for r in data['hits'].get('hits', [])]
     authors = {}
     for change in changes:
         for f in change['changed_files']:
@@ -911,3 +1212,7 @@ def authors_by_file_map(es, index, repository_fullname, params):
                 authors[key] = set()
                 authors[key].add(change['author'])
     return {'authors': authors}
+
+
+# Map the public query names to their functions for the run_named_query dispatch
+QUERY_REGISTRY = {name: globals()[name] for name in public_queries}
@@ -16,6 +16,7 @@
 
 import logging
 import unittest
+from unittest import mock
 
 from deepdiff import DeepDiff
 
@@ -684,7 +685,7 @@ class TestQueries(unittest.TestCase):
         ret = self.eldb.run_named_query('most_active_authors_stats', '.*', params)
         expected = {
             'ChangeCommentedEvent': {
-                'count_avg': 1,
+                'count_avg': 1.0,
                 'count_median': 1.0,
                 'items': [
                     {'doc_count': 1, 'key': 'jane'},
@@ -695,7 +696,7 @@ class TestQueries(unittest.TestCase):
             },
             'ChangeCreatedEvent': {
                 'count_avg': 1.3333333333333333,
-                'count_median': 1,
+                'count_median': 1.0,
                 'items': [
                     {'doc_count': 2, 'key': 'jane'},
                     {'doc_count': 1, 'key': 'john'},
@@ -705,8 +706,8 @@ class TestQueries(unittest.TestCase):
                 'total_hits': 4,
             },
             'ChangeMergedEvent': {
-                'count_avg': 1,
-                'count_median': 1,
+                'count_avg': 1.0,
+                'count_median': 1.0,
                 'items': [
                     {'doc_count': 1, 'key': 'jane'},
                     {'doc_count': 1, 'key': 'john'},
@@ -717,7 +718,7 @@ class TestQueries(unittest.TestCase):
             },
             'ChangeReviewedEvent': {
                 'count_avg': 1.3333333333333333,
-                'count_median': 1,
+                'count_median': 1.0,
                 'items': [
                     {'doc_count': 2, 'key': 'john'},
                     {'doc_count': 1, 'key': 'jane'},
@@ -736,29 +737,29 @@ class TestQueries(unittest.TestCase):
         ret = self.eldb.run_named_query('most_active_authors_stats', '.*', params)
         expected = {
             'ChangeCommentedEvent': {
-                'count_avg': 1,
-                'count_median': 1,
+                'count_avg': 1.0,
+                'count_median': 1.0,
                 'items': [{'doc_count': 1, 'key': 'jane'}],
                 'total': 1,
                 'total_hits': 1,
             },
             'ChangeCreatedEvent': {
-                'count_avg': 2,
-                'count_median': 2,
+                'count_avg': 2.0,
+                'count_median': 2.0,
                 'items': [{'doc_count': 2, 'key': 'jane'}],
                 'total': 1,
                 'total_hits': 2,
             },
             'ChangeMergedEvent': {
-                'count_avg': 1,
-                'count_median': 1,
+                'count_avg': 1.0,
+                'count_median': 1.0,
                 'items': [{'doc_count': 1, 'key': 'jane'}],
                 'total': 1,
                 'total_hits': 1,
             },
             'ChangeReviewedEvent': {
-                'count_avg': 1,
-                'count_median': 1,
+                'count_avg': 1.0,
+                'count_median': 1.0,
                 'items': [{'doc_count': 1, 'key': 'jane'}],
                 'total': 1,
                 'total_hits': 1,
@@ -767,3 +768,131 @@ class TestQueries(unittest.TestCase):
         ddiff = DeepDiff(ret, expected)
         if ddiff:
             raise DiffException(ddiff)
+
+    def test_cold_changes(self):
+        """
+        Test query: cold_changes
+        """
+        params = set_params({'lte': '2020-01-04'})
+        ret = self.eldb.run_named_query('cold_changes', 'unit/repo[12]', params)
+        self.assertListEqual([c['id'] for c in ret['items']], ['c2'])
+
+        # c2 has been reviewed on 2020-01-05
+        params = set_params({})
+        ret = self.eldb.run_named_query('cold_changes', 'unit/repo[12]', params)
+        self.assertListEqual(ret['items'], [])
+
+    def test_first_event_on_changes(self):
+        """
+        Test queries: first_comment_on_changes, first_review_on_changes
+        """
+        params = set_params({})
+        ret = self.eldb.run_named_query(
+            'first_comment_on_changes', 'unit/repo1', params
+        )
+        expected = {'first_event_delay_avg': 3600, 'top_authors': [('jane', 1)]}
+        self.assertDictEqual(ret, expected)
+
+        params = set_params({})
+        ret = self.eldb.run_named_query('first_review_on_changes', 'unit/repo1', params)
+        expected = {'first_event_delay_avg': 3600, 'top_authors': [('john', 1)]}
+        self.assertDictEqual(ret, expected)
+
+    def test_peers_exchange_strength(self):
+        """
+        Test query: peers_exchange_strength
+        """
+        params = set_params({})
+        ret = self.eldb.run_named_query('peers_exchange_strength', 'unit/repo1', params)
+        self.assertListEqual(ret, [(('jane', 'john'), 2)])
+
+    def test_repository_param(self):
+        """
+        Test repository names and regexps: last_changes
+        """
+        params = set_params({})
+        ret = self.eldb.run_named_query('last_changes', 'unit/repo2', params)
+        self.assertEqual(ret['total'], 3, ret)
+        params = set_params({})
+        ret = self.eldb.run_named_query('last_changes', 'unit/repo1|unit/repo2', params)
+        self.assertEqual(ret['total'], 4, ret)
+        params = set_params({})
+        ret = self.eldb.run_named_query('last_changes', 'unit/repo1|unit/.*2', params)
+        self.assertEqual(ret['total'], 4, ret)
+
+    def test_track_total_hits_param(self):
+        """
+        Test track_total_hits param: last_changes
+        """
+        params = set_params({'track_total_hits': 'false'})
+        ret = self.eldb.run_named_query('last_changes', 'unit/repo[12]', params)
+        self.assertNotIn('total', ret)
+        self.assertEqual(len(ret['items']), 4, ret)
+
+    def test_search_after_param(self):
+        """
+        Test search_after param: last_changes
+        """
+        ids = []
+        search_after = None
+        for _ in range(3):
+            params = set_params({'size': 2, 'search_after': search_after})
+            ret = self.eldb.run_named_query('last_changes', 'unit/repo[12]', params)
+            ids.extend([change['id'] for change in ret['items']])
+            search_after = ret.get('search_after')
+        self.assertCountEqual(ids, ['c1', 'c2', 'c3', 'c4'])
+
+        # An invalid token is ignored and the first page is returned
+        params = set_params({'size': 2})
+        expected = self.eldb.run_named_query('last_changes', 'unit/repo[12]', params)
+        for search_after in ('garbage', '42', 'notadate,c1'):
+            params = set_params({'size': 2, 'search_after': search_after})
+            ret = self.eldb.run_named_query('last_changes', 'unit/repo[12]', params)
+            self.assertListEqual(ret['items'], expected['items'])
+
+    def test_new_contributors(self):
+        """
+        Test query: new_contributors
+        """
+        params = set_params({'gte': '2020-01-03'})
+        ret = self.eldb.run_named_query('new_contributors', 'unit/repo[12]', params)
+        expected = [{'key': 'steve', 'doc_count': 3}, {'key': 'bot', 'doc_count': 1}]
+        self.assertListEqual(ret['items'], expected)
+
+
+class TestHotChangesQuery(unittest.TestCase):
+
+    index = 'monocle-unittest-hot'
+    datasets = [
+        'objects/unit_repo3.json',
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.eldb = ELmonocleDB(index=cls.index, prefix='monocle.test.')
+        for dataset in cls.datasets:
+            index_dataset(cls.eldb, dataset)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.eldb.es.indices.delete(index=cls.eldb.prefix + cls.index)
+
+    def test_hot_changes(self):
+        """
+        Test query: hot_changes
+        """
+        # c5 got 3 comments and c6 only one, so the average is 2
+        params = set_params({})
+        ret = self.eldb.run_named_query('hot_changes', 'unit/repo3', params)
+        self.assertListEqual(
+            [(c['id'], c['hot_score']) for c in ret['items']], [('c5', 3)]
+        )
+
+        # The average is computed on all the commented changes, not only on
+        # the candidates
+        with mock.patch.object(queries, 'HOT_CHANGES_CANDIDATES', 1):
+            params = set_params({})
+            ret = self.eldb.run_named_query('hot_changes', 'unit/repo3', params)
+        self.assertListEqual(
+            [(c['id'], c['hot_score']) for c in ret['items']], [('c5', 3)]
+        )
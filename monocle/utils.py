@@ -191,6 +191,8 @@ def set_params(input):
     params['has_issue_tracker_links'] = getter('has_issue_tracker_links', None)
     params['change_ids'] = getter('change_ids', None)
     params['target_branch'] = getter('target_branch', None)
+    params['track_total_hits'] = getter('track_total_hits', 'true') != 'false'
+    params['search_after'] = getter('search_after', None)
     for sp in (
         'change_ids',
         'exclude_authors',
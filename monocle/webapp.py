@@ -16,8 +16,10 @@
 
 import os
 import sys
+import orjson
 import yaml
 
+from functools import lru_cache
 from typing import Dict, List
 
 from flask import Flask
@@ -25,6 +27,7 @@ from flask import abort
 from flask import jsonify
 from flask import make_response
 from flask import request
+from flask import Response
 from flask import redirect
 from flask import session
 from flask_cors import CORS
@@ -124,29 +127,45 @@ def query(name):
     return do_query(index, repository_fullname, request.args, name)
 
 
-@cache.memoize(timeout=CACHE_TIMEOUT)
-def do_query(index, repository_fullname, args, name):
-    params = utils.set_params(args)
-    db = ELmonocleDB(
+@lru_cache(maxsize=1)
+def get_es():
+    # Share a single ES client and its connection pool between the requests
+    # and the indices
+    return ELmonocleDB(
         elastic_conn=os.getenv('ELASTIC_CONN', 'localhost:9200'),
-        index=index,
         prefix=CHANGE_PREFIX,
         create=False,
-    )
+        # Query results are large and repetitive JSON documents
+        http_compress=True,
+    ).es
+
+
+@lru_cache(maxsize=64)
+def _get_db(prefix, index):
+    return ELmonocleDB(index=index, prefix=prefix, create=False, es=get_es())
+
+
+def get_db(index=None):
+    return _get_db(CHANGE_PREFIX, index)
+
+
+@cache.memoize(timeout=CACHE_TIMEOUT)
+def do_query(index, repository_fullname, args, name):
+    params = utils.set_params(args)
+    db = get_db(index)
     try:
         result = db.run_named_query(name, repository_fullname, params)
     except InvalidIndexError:
         return 'Invalid index: %s' % request.args.get('index'), 404
-    return jsonify(result)
+    return Response(
+        orjson.dumps(result, option=orjson.OPT_NON_STR_KEYS),
+        mimetype='application/json',
+    )
 
 
 @app.route("/api/0/indices", methods=['GET'])
 def indices():
-    db = ELmonocleDB(
-        elastic_conn=os.getenv('ELASTIC_CONN', 'localhost:9200'),
-        create=False,
-        prefix=CHANGE_PREFIX,
-    )
+    db = get_db()
     _indices = db.get_indices()
     indices = []
     for indice in _indices: